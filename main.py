@@ -1,17 +1,23 @@
+import hmac
 import logging
 import time
-import uuid
+from collections import OrderedDict
 from collections.abc import AsyncIterator
 from contextlib import asynccontextmanager
+from hashlib import blake2b
 from pathlib import Path
+from secrets import token_hex
 from typing import Any
 
 import google.genai as genai
+import httpx
+import orjson
 import uvicorn
 import yaml
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import Response, StreamingResponse
 from google.genai import types
+from starlette.concurrency import run_in_threadpool
 
 logging.basicConfig(
     level=logging.INFO,
@@ -23,11 +29,22 @@ logger = logging.getLogger(__name__)
 CONFIG_FILE = Path(__file__).parent / "config.yaml"
 SYSTEM_PROMPT_FILE = Path(__file__).parent / "system_prompt.md"
 
+# Use libyaml's C loader when available, it is much faster than the pure
+# Python SafeLoader
+_YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# Logged user and model messages are truncated to this many characters
+LOG_PREVIEW_CHARS = 200
+
 # Module-level state, initialized during lifespan
 client: genai.Client | None = None
 gemini_model: str = ""
-bearer_token: str = ""
+bearer_token: bytes = b""
 server_port: int = 8000
+system_prompt: str = ""
+generate_config: types.GenerateContentConfig | None = None
+dedup_template: bytes = b""
+model_json: bytes = b'""'
 
 
 def load_config() -> dict[str, Any]:
@@ -38,24 +55,53 @@ def load_config() -> dict[str, Any]:
         raise RuntimeError("config.yaml not found")
 
     with open(CONFIG_FILE) as f:
-        return yaml.safe_load(f)
+        return yaml.load(f, Loader=_YAML_LOADER)
+
+
+def read_system_prompt() -> str:
+    """Read the system prompt from the markdown file."""
+    try:
+        return SYSTEM_PROMPT_FILE.read_text().strip()
+    except FileNotFoundError:
+        logger.warning("System prompt file not found: %s", SYSTEM_PROMPT_FILE)
+        return "You are a helpful AI assistant."
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI) -> AsyncIterator[None]:
     """Initialize application state on startup."""
-    global client, gemini_model, bearer_token, server_port
+    global client, gemini_model, bearer_token, server_port, system_prompt, generate_config
+    global dedup_template, model_json
 
-    config = load_config()
+    config = await run_in_threadpool(load_config)
     gemini_model = config.get("gemini_model", "gemini-3-flash-preview")
-    bearer_token = config.get("token", "")
+    bearer_token = config.get("token", "").encode()
     server_port = config.get("server", {}).get("port", 8000)
+    system_prompt = await run_in_threadpool(read_system_prompt)
+    generate_config = types.GenerateContentConfig(system_instruction=system_prompt)
+    model_json = orjson.dumps(gemini_model)
+    dedup_template = _DEDUP_TEMPLATE.replace(b'"__MODEL__"', model_json)
 
     api_key = config.get("gemini_api_key")
     if not api_key or api_key == "your-api-key-here":
         logger.warning("GEMINI_API_KEY not configured properly. API calls will fail.")
     else:
-        client = genai.Client(api_key=api_key)
+        # Keep a pool of multiplexed HTTP/2 connections to the Gemini API so
+        # concurrent requests don't each pay for connection and TLS setup.
+        # The SDK passes its own per-request timeout (in milliseconds) to httpx,
+        # so it only supports a single total timeout set here.
+        http_options = types.HttpOptions(
+            timeout=60_000,
+            async_client_args={
+                "http2": True,
+                "limits": httpx.Limits(
+                    max_connections=100,
+                    max_keepalive_connections=50,
+                    keepalive_expiry=30.0,
+                ),
+            },
+        )
+        client = genai.Client(api_key=api_key, http_options=http_options)
         logging.getLogger("google_genai.models").setLevel(logging.WARNING)
         logger.info("Gemini client initialized with model: %s", gemini_model)
 
@@ -66,155 +112,282 @@ async def lifespan(app: FastAPI) -> AsyncIterator[None]:
 
 app = FastAPI(title="EvenAI Gemini Bridge", version="0.1.0", lifespan=lifespan)
 
-# Track last request for deduplication
-_last_request: dict[str, Any] = {}
+# Track last request per client for deduplication, oldest first. Only a short
+# digest of the message is kept so large prompts are not retained between
+# requests.
+_last_requests: OrderedDict[str, tuple[bytes, float]] = OrderedDict()
 
 # Duplicate requests arriving within this window are silently discarded.
 # The device sometimes fires the same request twice in quick succession.
 DEDUP_WINDOW_S = 0.5
 
+# Upper bound on the number of clients tracked for deduplication.
+DEDUP_MAX_CLIENTS = 1024
 
-def read_system_prompt() -> str:
-    """Read the system prompt from the markdown file."""
-    try:
-        return SYSTEM_PROMPT_FILE.read_text().strip()
-    except FileNotFoundError:
-        logger.warning("System prompt file not found: %s", SYSTEM_PROMPT_FILE)
-        return "You are a helpful AI assistant."
 
+def _completion_body(model: bytes, created: int, content: str) -> bytes:
+    """
+    Render an OpenAI chat completion body.
+    The envelope has a fixed shape, so only the JSON encoded model name and the
+    message content need serializing.
+    """
+    return b"".join(
+        (
+            b'{"id":"chatcmpl-',
+            token_hex(6).encode(),
+            b'","object":"chat.completion","created":',
+            str(created).encode(),
+            b',"model":',
+            model,
+            b',"choices":[{"index":0,"message":{"role":"assistant","content":',
+            orjson.dumps(content),
+            b'},"finish_reason":"stop"}]}',
+        )
+    )
+
+
+# Canned response bodies, serialized once. The dedup template only needs its
+# volatile fields patched in per request; a copy with the configured model
+# already filled in is prepared during lifespan.
+_AUTH_FAIL_BODY = b'{"error":"unauthorized"}'
+_DEDUP_TEMPLATE = orjson.dumps(
+    {
+        "id": "__ID__",
+        "object": "chat.completion",
+        "created": 0,
+        "model": "__MODEL__",
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": ""},
+                "finish_reason": "stop",
+            }
+        ],
+    }
+)
+
+
+# OpenAI roles mapped to their Gemini counterparts. System messages are
+# handled separately via system_instruction and are skipped here.
+_ROLE_MAP = {"user": "user", "assistant": "model"}
+
+
+def _text_parts(content: Any) -> list[types.Part]:
+    """
+    Convert OpenAI message content to Gemini text parts.
+    Content is either a string or a list of typed parts, of which only the
+    text parts are kept; images and other part types are skipped.
+    """
+    if isinstance(content, str):
+        return [types.Part.from_text(text=content)]
+    if isinstance(content, list):
+        return [
+            types.Part.from_text(text=part["text"])
+            for part in content
+            if isinstance(part, dict)
+            and part.get("type") == "text"
+            and isinstance(part.get("text"), str)
+        ]
+    return []
+
+
+def convert_messages_to_gemini(
+    messages: list[dict[str, Any]],
+) -> tuple[list[types.Content], Any]:
+    """
+    Convert OpenAI format messages to Gemini format.
+    Also returns the content of the last user message, or None if there is none.
+    """
+    gemini_contents = []
+    last_user_content = None
 
-def convert_messages_to_gemini(messages: list[dict[str, Any]]) -> list[dict[str, Any]]:
-    """Convert OpenAI format messages to Gemini format."""
-    gemini_messages = []
-    
     for msg in messages:
-        role = msg.get("role")
-        content = msg.get("content", "")
-        
-        if role == "system":
-            # System messages are handled separately in the new API
+        role = _ROLE_MAP.get(msg.get("role"))
+        if role is None:
             continue
-        elif role == "user":
-            gemini_messages.append({"role": "user", "parts": [{"text": content}]})
-        elif role == "assistant":
-            gemini_messages.append({"role": "model", "parts": [{"text": content}]})
-    
-    return gemini_messages
+        content = msg.get("content", "")
+        parts = _text_parts(content)
+        if parts:
+            gemini_contents.append(types.Content(role=role, parts=parts))
+        if role == "user":
+            last_user_content = content
+
+    return gemini_contents, last_user_content
+
+
+# Sent in place of further chunks when a stream fails after it has started
+_SSE_ERROR_EVENT = (
+    b"data: "
+    + orjson.dumps({"error": {"message": "Internal server error", "type": "server_error"}})
+    + b"\n\n"
+)
+
+
+def _sse_event(
+    completion_id: str,
+    created: int,
+    model: Any,
+    delta: dict[str, str],
+    finish_reason: str | None = None,
+) -> bytes:
+    """Render one OpenAI-style chat.completion.chunk server-sent event."""
+    chunk = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    return b"data: " + orjson.dumps(chunk) + b"\n\n"
+
+
+async def _sse_empty(model: Any, created: int) -> AsyncIterator[bytes]:
+    """Stream an empty completion, used to answer duplicate streamed requests."""
+    yield _sse_event(f"chatcmpl-{token_hex(6)}", created, model, {}, finish_reason="stop")
+    yield b"data: [DONE]\n\n"
+
+
+async def _sse_gen(
+    stream: AsyncIterator[types.GenerateContentResponse],
+    first_chunk: types.GenerateContentResponse | None,
+    model: Any,
+    created: int,
+) -> AsyncIterator[bytes]:
+    """
+    Stream a Gemini response as OpenAI-style server-sent events.
+    The first chunk has already been taken from the stream by the caller.
+    """
+    completion_id = f"chatcmpl-{token_hex(6)}"
+
+    def event(delta: dict[str, str], finish_reason: str | None = None) -> bytes:
+        return _sse_event(completion_id, created, model, delta, finish_reason)
+
+    yield event({"role": "assistant"})
+    chunk = first_chunk
+    try:
+        while chunk is not None:
+            if chunk.text:
+                yield event({"content": chunk.text})
+            chunk = await anext(stream, None)
+        yield event({}, finish_reason="stop")
+    except Exception:
+        logger.exception("Error streaming response")
+        yield _SSE_ERROR_EVENT
+    yield b"data: [DONE]\n\n"
 
 
 @app.post("/v1/chat/completions")
-async def chat_completions(request: Request) -> JSONResponse:
+async def chat_completions(request: Request) -> Response:
     """
     OpenAI-compatible chat completions endpoint.
     Forwards requests to Google Gemini API.
     """
     request_time = time.monotonic()
 
-    # Verify bearer token
-    auth_header = request.headers.get("authorization", "")
-    if not auth_header.startswith("Bearer ") or auth_header[7:] != bearer_token:
-        return JSONResponse(
-            status_code=200,
-            content={
-                "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
-                "object": "chat.completion",
-                "created": int(time.time()),
-                "model": "error",
-                "choices": [
-                    {
-                        "index": 0,
-                        "message": {
-                            "role": "assistant",
-                            "content": "Authorization failed. Invalid or missing token.",
-                        },
-                        "finish_reason": "stop",
-                    }
-                ],
-            },
-        )
+    # Verify bearer token before doing any work on the request body. The raw
+    # header bytes are compared directly to avoid decoding them.
+    auth_header = b""
+    for name, value in request.headers.raw:
+        if name == b"authorization":
+            auth_header = value
+            break
+    if not auth_header.startswith(b"Bearer ") or not hmac.compare_digest(
+        auth_header[7:], bearer_token
+    ):
+        return Response(_AUTH_FAIL_BODY, status_code=401, media_type="application/json")
 
-    body = await request.json()
+    created = int(time.time())
+    body = orjson.loads(await request.body())
     
     if not client:
         raise HTTPException(status_code=500, detail="GEMINI_API_KEY not configured")
     
     try:
-        # Read system prompt
-        system_prompt = read_system_prompt()
-        
         # Extract messages from request
         messages = body.get("messages", [])
+        model = body.get("model", gemini_model)
+        stream_requested = body.get("stream", False)
+        
+        # Convert to Gemini format, picking up the last user message on the way
+        gemini_contents, content = convert_messages_to_gemini(messages)
         
         # Log the last user message
-        last_user_message = next((m for m in reversed(messages) if m.get("role") == "user"), None)
-        if last_user_message:
-            content = last_user_message.get("content")
-            logger.info("User: %s", content)
-            
-            # Discard duplicate: same message arriving within the dedup window
-            last = _last_request.get("content")
-            last_time = _last_request.get("time", 0.0)
+        if content is not None and logger.isEnabledFor(logging.INFO):
+            logger.info(
+                "User: %s",
+                content[:LOG_PREVIEW_CHARS]
+                if isinstance(content, str)
+                else "<non-text content>",
+            )
+        
+        # Discard duplicate: same message arriving within the dedup window.
+        # Non-text (multimodal) content is neither compared nor remembered.
+        if isinstance(content, str):
+            digest = blake2b(content.encode(), digest_size=8).digest()
+            client_key = request.client.host if request.client else "global"
+            while (
+                _last_requests
+                and request_time - next(iter(_last_requests.values()))[1] > DEDUP_WINDOW_S
+            ):
+                _last_requests.popitem(last=False)
+            last, last_time = _last_requests.get(client_key, (b"", 0.0))
             delta = request_time - last_time
-            if content == last and delta < DEDUP_WINDOW_S:
+            if digest == last and delta < DEDUP_WINDOW_S:
                 logger.warning("Duplicate request discarded (%.2fs apart)", delta)
-                return JSONResponse(
-                    status_code=200,
-                    content={
-                        "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
-                        "object": "chat.completion",
-                        "created": int(time.time()),
-                        "model": body.get("model", gemini_model),
-                        "choices": [
-                            {
-                                "index": 0,
-                                "message": {
-                                    "role": "assistant",
-                                    "content": "",
-                                },
-                                "finish_reason": "stop",
-                            }
-                        ],
-                    },
+                if stream_requested:
+                    return StreamingResponse(
+                        _sse_empty(model, created), media_type="text/event-stream"
+                    )
+                template = (
+                    dedup_template
+                    if model == gemini_model
+                    else _DEDUP_TEMPLATE.replace(b'"__MODEL__"', orjson.dumps(model))
                 )
-            _last_request["content"] = content
-            _last_request["time"] = request_time
+                dedup_body = template.replace(
+                    b'"__ID__"', f'"chatcmpl-{token_hex(6)}"'.encode()
+                ).replace(b'"created":0', f'"created":{created}'.encode())
+                return Response(dedup_body, media_type="application/json")
+            _last_requests[client_key] = (digest, request_time)
+            _last_requests.move_to_end(client_key)
+            if len(_last_requests) > DEDUP_MAX_CLIENTS:
+                _last_requests.popitem(last=False)
         
-        # Convert to Gemini format
-        gemini_contents = convert_messages_to_gemini(messages)
+        if stream_requested:
+            # Wait for the first chunk before responding, the SDK only sends the
+            # request once iteration starts. Upstream failures then still end up
+            # as a 500 instead of an empty stream.
+            stream = await client.aio.models.generate_content_stream(
+                model=gemini_model,
+                contents=gemini_contents,
+                config=generate_config,
+            )
+            first_chunk = await anext(stream, None)
+            return StreamingResponse(
+                _sse_gen(stream, first_chunk, model, created),
+                media_type="text/event-stream",
+            )
         
         # Generate response using new API
         response = await client.aio.models.generate_content(
             model=gemini_model,
             contents=gemini_contents,
-            config=types.GenerateContentConfig(
-                system_instruction=system_prompt,
-            ),
+            config=generate_config,
         )
         
         # Extract response text
         response_text = getattr(response, "text", "") or ""
         
-        logger.info("Model: %s", response_text)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Model: %s", response_text[:LOG_PREVIEW_CHARS])
         
         # Convert response to OpenAI format
-        return JSONResponse(
-            status_code=200,
-            content={
-                "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
-                "object": "chat.completion",
-                "created": int(time.time()),
-                "model": body.get("model", gemini_model),
-                "choices": [
-                    {
-                        "index": 0,
-                        "message": {
-                            "role": "assistant",
-                            "content": response_text,
-                        },
-                        "finish_reason": "stop",
-                    }
-                ],
-            },
+        return Response(
+            _completion_body(
+                model_json if model == gemini_model else orjson.dumps(model),
+                created,
+                response_text,
+            ),
+            media_type="application/json",
         )
     
     except Exception:
@@ -232,7 +405,18 @@ def main() -> None:
     """Run the server."""
     config = load_config()
     port = config.get("server", {}).get("port", 8000)
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    workers = config.get("server", {}).get("workers", 1)
+    uvicorn.run(
+        # Multiple workers need the import string so each process can load the app
+        "main:app" if workers > 1 else app,
+        host="0.0.0.0",
+        port=port,
+        workers=workers,
+        loop="uvloop",
+        http="httptools",
+        log_level="warning",
+        access_log=False,
+    )
 
 
 if __name__ == "__main__":